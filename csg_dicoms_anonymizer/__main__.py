@@ -1,2 +1,9 @@
+import multiprocessing
+import sys
+
 from .csg_dicoms_anonymizer import main
-main()
+
+# Guard needed by multiprocessing: on Windows, the child processes re-import the main module, which must not launch the whole program again
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # necessary for multiprocessing to work in a frozen (pyinstaller) executable on Windows
+    sys.exit(main())
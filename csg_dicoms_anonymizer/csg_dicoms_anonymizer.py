@@ -47,6 +47,12 @@ import zipfile
 import cStringIO
 import csv
 import hashlib
+import binascii
+import itertools
+import multiprocessing
+
+from collections import OrderedDict, defaultdict
+from functools import partial
 
 cur_path = os.path.realpath('.')
 sys.path.append(os.path.join(cur_path, 'csg_fileutil_libs'))  # for pydicom, because it does not support relative paths (yet?)
@@ -54,12 +60,13 @@ sys.path.append(os.path.join(cur_path, 'csg_fileutil_libs'))  # for pydicom, bec
 from tempfile import mkdtemp, mkstemp
 
 import csg_fileutil_libs.pydicom as dicom
-from csg_fileutil_libs.pydicom.filereader import InvalidDicomError
+from csg_fileutil_libs.pydicom.filereader import InvalidDicomError, read_partial
+from csg_fileutil_libs.pydicom.tag import Tag
 from csg_fileutil_libs.distance import distance
 from csg_fileutil_libs.tee import Tee
 from csg_fileutil_libs import argparse
 
-from csg_fileutil_libs.aux_funcs import recwalk, replace_buggy_accents, _unidecode, _tqdm, cleanup_name, save_dict_as_csv, distance_jaccard_words_split
+from csg_fileutil_libs.aux_funcs import recwalk, walk_files, replace_buggy_accents, _unidecode, _tqdm, cleanup_name, save_dict_as_csv, read_csv_columns, distance_jaccard_words, distance_jaccard_words_bound, distance_jaccard_words_many, split_words, nlevenshtein, nlevenshtein_leq, nlevenshtein_extract, get_chars_mask, get_levenshtein_masks, build_bigrams_index, get_bigrams_candidates
 
 
 
@@ -67,6 +74,11 @@ from csg_fileutil_libs.aux_funcs import recwalk, replace_buggy_accents, _unideco
 #                       AUX
 #***********************************
 
+# Precompiled regular expressions
+NONWORD_REGEX = re.compile(r'\W')
+NONLETTERS_REGEX = re.compile(r'[^a-zA-Z]+')
+ZIP_TOP_FOLDER_REGEX = re.compile('^([^\\/]+)[\\/]')
+
 def is_file(dirname):
     """Checks if a path is an actual file that exists"""
     if not os.path.isfile(dirname):
@@ -97,6 +109,25 @@ def get_fullpath(relpath):
         relpath = relpath.name
     return os.path.abspath(os.path.expanduser(relpath))
 
+class AsciiAlnumTable(dict):
+    """Lazily filled unicode.translate() table, mapping each character to its lowercased ascii transliteration without non-alphanumerical characters (or deleting it if nothing remains).
+    Since unidecode transliterates each character independently, translating a string with this table is the same as re.sub(r'\W', '', _unidecode(s).lower()), but in a single C pass once each character was seen."""
+    def __missing__(self, codepoint):
+        rep = unicode(NONWORD_REGEX.sub(r'', _unidecode(unichr(codepoint)).lower())) or None
+        self[codepoint] = rep
+        return rep
+
+ascii_alnum_table = AsciiAlnumTable()
+
+# unicode.translate() table mapping each latin1 character to its lowercased ascii transliteration, and ^ (the separator of dicom names) to a space
+LATIN1_ASCII_LOWER_TABLE = dict((codepoint, unicode(_unidecode(unichr(codepoint)).lower())) for codepoint in range(256))
+LATIN1_ASCII_LOWER_TABLE[ord('^')] = u' '
+
+def normalize_dcm_name(s):
+    """Convert a latin1 dicom string (eg, a PatientName) to lowercased ascii, with ^ replaced by spaces.
+    Same as _unidecode(s.decode('latin1').replace('^', ' ')).lower(), but in a single C pass instead of one pass per operation."""
+    return s.decode('latin1').translate(LATIN1_ASCII_LOWER_TABLE).encode('ascii')
+
 def disambiguate_names(L, dist_threshold=0.2, verbose=False):
     '''Disambiguate names in a list (ie, find all duplicate names with switched words or typos, and fix them and add them to an "alt_names" field)
     Input: list of names or list of dicts with "name" field. Output: list of dict with fields "name" and "alt_names". Alt names can then be used to do a mapping.'''
@@ -107,17 +138,29 @@ def disambiguate_names(L, dist_threshold=0.2, verbose=False):
     else:  # Convert input list to a dict
         res = [{'name': name} for name in L]
         vals = L
+    # Blocking: below a distance of 0.5, two similar names always share at least one bigram, so we only need to compare these candidates (instead of all pairs)
+    bigrams_index = build_bigrams_index(vals) if dist_threshold < 0.5 else None
+    # Split names in words only once, instead of at every comparison
+    words = [split_words(c) for c in vals]
+    words_counts = [len(w) - w.count('') for w in words]  # to quickly discard names with too different numbers of words
+    masks = [get_chars_mask(c) for c in vals]  # to quickly discard pairs too dissimilar for nlevenshtein
     for idx, c in _tqdm(enumerate(vals), total=len(vals), desc='DISAMB', unit='names', file=sys.stdout):
-        for idx2, c2 in enumerate(vals[idx+1:]):
+        if bigrams_index is not None:
+            candidates = sorted(idx2 for idx2 in get_bigrams_candidates(c, bigrams_index) if idx2 > idx)
+        else:
+            candidates = range(idx+1, len(vals))
+        peq = get_levenshtein_masks(c)  # shared by all the comparisons of c
+        for idx2 in candidates:
+            c2 = vals[idx2]
             #print(c, c2)
             if c != c2 and \
-            (distance.nlevenshtein(c, c2, method=1) <= dist_threshold or distance_jaccard_words_split(c2, c, partial=True, norm=True, dist=dist_threshold) <= dist_threshold): # use shortest distance with normalized levenshtein
+            (nlevenshtein_leq(c, c2, dist_threshold, masks[idx], masks[idx2], peq) or (distance_jaccard_words_bound(words_counts[idx2], words_counts[idx]) <= dist_threshold and distance_jaccard_words(words[idx2], words[idx], partial=True, norm=True, dist=dist_threshold) <= dist_threshold)): # use shortest distance with normalized levenshtein
                 if verbose:
-                    print(c, c2, distance.nlevenshtein(c, c2, method=1))
+                    print(c, c2, nlevenshtein(c, c2))
                 # Replace the name of the second entry with the name of the first entry
-                res[idx+idx2+1]['name'] = c
+                res[idx2]['name'] = c
                 # Add the other name as an alternative name, just in case we did a mistake for example
-                res[idx+idx2+1]['alt_names'] = res[idx]['alt_names'] + '/' + c2 if 'alt_names' in res[idx] else c2
+                res[idx2]['alt_names'] = res[idx]['alt_names'] + '/' + c2 if 'alt_names' in res[idx] else c2
     return res
 
 def get_list_of_folders(rootpath):
@@ -126,44 +169,82 @@ def get_list_of_folders(rootpath):
 def get_list_of_zip(rootpath):
     return [item for item in os.listdir(rootpath) if os.path.isfile(os.path.join(rootpath, item)) and item.endswith('.zip')]
 
-def get_dcm_names_from_dir(rootpath, dcm_subj_list=None, folder_to_name=None, verbose=False):
+PATIENT_NAME_TAG = Tag(0x0010, 0x0010)
+
+def _after_patient_name(tag, VR, length):
+    """Stop condition for read_partial(): data elements are stored in ascending tags order, so we can stop as soon as we reach a tag after PatientName"""
+    return tag > PATIENT_NAME_TAG
+
+def read_dcm_patient_name(fp, defer_size=256):
+    """Read a dicom file (path or file-like object) only up to the PatientName field, which is at the beginning of the header. This is much faster than stop_before_pixels, which still parses the whole header."""
+    if isinstance(fp, basestring):
+        with open(fp, 'rb') as fh:
+            return read_partial(fh, stop_when=_after_patient_name, defer_size=defer_size)
+    return read_partial(fp, stop_when=_after_patient_name, defer_size=defer_size)
+
+def _extract_name_for_subject(subject, rootpath, verbose=False):
+    """Extract the cleaned patient name from the first readable dicom file of a subject folder.
+    This is defined at module level and returns only strings (not the Dataset) so that it can be pickled by multiprocessing."""
+    if verbose:
+        print('- Processing subject %s' % (subject if isinstance(subject, unicode) else unicode(subject, 'latin1')))
+    fullpath = os.path.join(rootpath, subject)
+    if not isinstance(fullpath, unicode):
+        fullpath = unicode(fullpath, 'latin1')
+    pts_name = None
+    for dirpath, filename in walk_files(fullpath, filetype=['.dcm', '']):  # generator, so we only list the folders up to the first readable dicom
+        try:
+            #print('* Try to read fields from dicom file: %s' % os.path.join(dirpath, filename))
+            dcmdata = read_dcm_patient_name(os.path.join(dirpath, filename))  # read only up to the PatientName field, this allows for faster processing since we do not read the full dicom data, and here we can use it because we do not modify the dicom, we only read it to extract the dicom patient name
+            #print(dcmdata.PatientName)
+            pts_name = cleanup_name(dcmdata.PatientName)
+            break
+        except (InvalidDicomError, AttributeError) as exc:
+            pass
+    return subject, pts_name
+
+def get_dcm_names_from_dir(rootpath, dcm_subj_list=None, folder_to_name=None, verbose=False, processes=None):
     if dcm_subj_list is None:
         dcm_subj_list = []  # store list of subjects names from dicom files (useful for csv filtering)
     if folder_to_name is None:
         folder_to_name = {}  # store the name of the patient stored in each root folder (useful for anonymization later on)
-    for subject in get_list_of_folders(rootpath):
-        if verbose:
-            print('- Processing subject %s' % unicode(subject, 'latin1'))
-        fullpath = os.path.join(rootpath, subject)
-        if not isinstance(fullpath, unicode):
-            fullpath = unicode(fullpath, 'latin1')
-        pts_name = None
-        for dirpath, filename in recwalk(fullpath, filetype=['.dcm', '']):
-            try:
-                #print('* Try to read fields from dicom file: %s' % os.path.join(dirpath, filename))
-                dcmdata = dicom.read_file(os.path.join(dirpath, filename), stop_before_pixels=True)  # stop_before_pixels allow for faster processing since we do not read the full dicom data, and here we can use it because we do not modify the dicom, we only read it to extract the dicom patient name
-                #print(dcmdata.PatientName)
-                pts_name = cleanup_name(dcmdata.PatientName)
+    subjects = get_list_of_folders(rootpath)
+    dcm_subj_seen = set(dcm_subj_list)  # several folders can belong to the same patient, store each name only once
+    extract_func = partial(_extract_name_for_subject, rootpath=rootpath, verbose=verbose)
+    if processes == 1 or len(subjects) <= 1:
+        results = itertools.imap(extract_func, subjects)
+        pool = None
+    else:
+        # Read the subjects in parallel (reading and parsing dicom files is the bottleneck), imap is ordered so that the output is the same as a sequential read
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(extract_func, subjects)
+    try:
+        for subject, pts_name in results:
+            if pts_name is not None and pts_name not in dcm_subj_seen:
+                dcm_subj_seen.add(pts_name)
                 dcm_subj_list.append( pts_name )
-                break
-            except (InvalidDicomError, AttributeError) as exc:
-                pass
-        folder_to_name[subject] = pts_name
+            folder_to_name[subject] = pts_name
+    except BaseException:
+        # stop all the workers at the first error or interruption, instead of waiting for all the queued subjects to be read
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return dcm_subj_list, folder_to_name
 
+DICOM_EXTS = ('.dcm', '.ima')  # extensions of files that are most probably dicoms, so we probe them first
+NON_DICOM_EXTS = frozenset(['.xml', '.txt', '.pdf', '.htm', '.html', '.jpg', '.jpeg', '.png'])  # extensions of files that are obviously not dicoms, so we do not even try to read them
+
 def get_dcm_names_from_zip(rootpath, dcm_subj_list=None, folder_to_name=None, verbose=False):
     if dcm_subj_list is None:
         dcm_subj_list = []  # store list of subjects names from dicom files (useful for csv filtering)
     if folder_to_name is None:
         folder_to_name = {}  # store the name of the patient stored in each root folder (useful for anonymization later on)
-    # Create a temporary file (to extract one dicom from zip)
-    dcmfilefh, dcmfilepath = mkstemp(suffix='.dcm')  # tesseract < 3.03 do not support "stdout" argument, so need to save into a file
-    os.close(dcmfilefh)  # close file to allow writing after
-    #dcmfilepath = 'tempdicomextract/tempdicom.dcm'
-    #try:
-    #    os.makedirs(os.path.dirname(dcmfilepath))
-    #except OSError as exc:
-    #    pass
+    dcm_subj_seen = set(dcm_subj_list)  # several zips can belong to the same patient, store each name only once
 
     # Extract names from zipped dicom files (extract the first dicom file we can read and use its fields)
     for zipfilename in get_list_of_zip(rootpath):
@@ -171,29 +252,32 @@ def get_dcm_names_from_zip(rootpath, dcm_subj_list=None, folder_to_name=None, ve
         if verbose:
             print('- Processing file %s' % zipfilename)
         with zipfile.ZipFile(zfilepath, 'r') as zipfh:
+            # List the zip members only once (infolist() returns the zip's own list, whereas namelist() builds a new list at each call)
+            zinfos = zipfh.infolist()
             # Extract only files, not directories (end with '/', this is standard detection in zipfile)
-            zfolder = (item for item in zipfh.namelist() if item.endswith('/'))
-            zfiles = (item for item in zipfh.namelist() if not item.endswith('/'))
+            zfolder = (info.filename for info in zinfos if info.filename.endswith('/'))
+            # Probe the most probable dicom files first (sort is stable so the zip order is otherwise kept), and skip the files that are obviously not dicoms
+            zfiles = sorted((info.filename for info in zinfos if not info.filename.endswith('/') and os.path.splitext(info.filename)[1].lower() not in NON_DICOM_EXTS),
+                            key=lambda item: not item.lower().endswith(DICOM_EXTS))
             # Get first top folder inside zip to extract folder name (because when we will extract the zip, we need the folder name)
             try:
                 folder_name = zfolder.next().strip('/')
             except StopIteration:
-                folder_name = re.search('^([^\\/]+)[\\/]', zipfh.namelist()[0]).group(1)
+                folder_name = ZIP_TOP_FOLDER_REGEX.search(zinfos[0].filename).group(1)
             # Get first dicom file we can find
             pts_name = None
             for zf in zfiles:
-                # Need to extract because pydicom does not support not having seek() (and zipfile in-memory does not provide seek())
-                z = zipfh.read(zf) # do not use .extract(), the path can be anything and it does not support unicode (so it can easily extract to the root instead of target folder!)
-                with open(dcmfilepath, 'wb') as dcmf:
-                    dcmf.write(z)
-                # Try to open the extracted dicom
+                # Need to read in memory because pydicom does not support not having seek() (and zipfile in-memory does not provide seek()), so we wrap the content in a seekable StringIO
+                z = cStringIO.StringIO(zipfh.read(zf)) # do not use .extract(), the path can be anything and it does not support unicode (so it can easily extract to the root instead of target folder!)
+                # Try to open the in-memory dicom
                 try:
                     if verbose:
                         print('Try to decode dicom fields with file %s' % zf)
-                    dcmdata = dicom.read_file(dcmfilepath, stop_before_pixels=True)
+                    dcmdata = read_dcm_patient_name(z)
                     pts_name = cleanup_name(dcmdata.PatientName)
-                    dcm_subj_list.append( pts_name )
-                    os.remove(dcmfilepath)
+                    if pts_name not in dcm_subj_seen:
+                        dcm_subj_seen.add(pts_name)
+                        dcm_subj_list.append( pts_name )
                     break
                 except (InvalidDicomError, AttributeError) as exc:
                     continue
@@ -206,18 +290,41 @@ def get_dcm_names_from_zip(rootpath, dcm_subj_list=None, folder_to_name=None, ve
             folder_to_name[folder_name] = pts_name
     return dcm_subj_list, folder_to_name
 
-def dist_matrix(list1, list2, dist_threshold=0.2):
-    '''Find all similar items in two lists that are below a specified distance threshold (using both letters- and words- levenshtein distances)'''
+class NamesIndex(object):
+    '''Precomputed words, characters masks and bigrams index of a list of names, so that the list can be matched several times with dist_matrix() without recomputing them'''
+    def __init__(self, names):
+        self.names = list(names)
+        # Split names in words only once, instead of at every comparison
+        self.words = [split_words(c) for c in self.names]
+        self.words_counts = [len(w) - w.count('') for w in self.words]
+        self.masks = [get_chars_mask(c) for c in self.names]
+        self.bigrams_index = build_bigrams_index(self.names)
+
+def dist_matrix(list1, list2, dist_threshold=0.2, progress=False):
+    '''Find all similar items in two lists that are below a specified distance threshold (using both letters- and words- levenshtein distances). list2 can also be a prebuilt NamesIndex, when matching against the same list several times.'''
     dist_matches = {}
+    index = list2 if isinstance(list2, NamesIndex) else NamesIndex(list2)
+    names = index.names
+    if progress:
+        list1 = _tqdm(list1, desc='distmat', unit='subj', file=sys.stdout)
     for subj in list1:
-        found = False
-        for c in list2:
-            if distance.nlevenshtein(subj, c, method=1) <= dist_threshold or distance_jaccard_words_split(subj, c, partial=True, norm=True, dist=dist_threshold) <= dist_threshold: # use shortest distance with normalized levenshtein
-                if subj not in dist_matches:
-                    dist_matches[subj] = []
-                dist_matches[subj].append(c)
-                found = True
-        if not found:
+        subj_words = split_words(subj)
+        subj_words_count = len(subj_words) - subj_words.count('')
+        if dist_threshold < 0.5:
+            # Blocking (see disambiguate_names): below a distance of 0.5, only the names of list2 sharing at least one bigram can match
+            candidates = sorted(get_bigrams_candidates(subj, index.bigrams_index))  # sort to keep list2 order
+        else:
+            candidates = range(len(names))
+        # Compute the letters distance to all candidates at once (in native code if rapidfuzz is available), then check the words distance only for the remaining candidates
+        letters_matches = nlevenshtein_extract(subj, [names[idx] for idx in candidates], dist_threshold, [index.masks[idx] for idx in candidates])
+        words_candidates = [idx for cidx, idx in enumerate(candidates)
+                            if cidx not in letters_matches and distance_jaccard_words_bound(subj_words_count, index.words_counts[idx]) <= dist_threshold]
+        words_dists = distance_jaccard_words_many(subj_words, [index.words[idx] for idx in words_candidates], partial=True, norm=True, dist=dist_threshold)
+        words_matches = set(idx for idx, d in zip(words_candidates, words_dists) if d <= dist_threshold)
+        matches = [names[idx] for cidx, idx in enumerate(candidates) if cidx in letters_matches or idx in words_matches]  # use shortest distance with normalized levenshtein
+        if matches:
+            dist_matches.setdefault(subj, []).extend(matches)
+        else:
             dist_matches[subj] = None
     return dist_matches
 
@@ -259,7 +366,8 @@ def zipwalk(zfilename):
                 
                 tmpfpath = os.path.join(tempdir,os.path.basename(fname))
                 try:
-                    open(tmpfpath,'w+b').write(data)
+                    with open(tmpfpath, 'wb', 1<<20) as tmpf:
+                        tmpf.write(data)
                 except (IOError, OSError),e:
                     print(e)
 
@@ -285,6 +393,173 @@ def zipwalk(zfilename):
         raise
 
 
+# In[ ]:
+
+# Value Representations of the dicom fields that can store a (patient's) name. Unknown VR (eg, private fields) are included since they are stored as raw strings.
+TEXT_VRS = frozenset(['AE', 'AS', 'CS', 'DA', 'DT', 'LO', 'LT', 'PN', 'SH', 'ST', 'TM', 'UC', 'UR', 'UT', 'UN'])
+
+# Value Representations of the binary dicom fields, which can also hide a name in non-standard files. Their repval shows the bytes only for short values (below 16 bytes), so that the pixel data is not formatted
+BINARY_VRS = frozenset(['OB', 'OW', 'OW/OB', 'OW or OB', 'OB or OW', 'US or SS or OW'])
+
+# Value Representations of the dicom fields that can only store numbers
+NUMERIC_VRS = frozenset(['AT', 'DS', 'FD', 'FL', 'IS', 'OD', 'OF', 'OL', 'SL', 'SS', 'UL', 'US', 'US or SS'])
+PIXEL_DATA_TAG = Tag(0x7fe0, 0x0010)
+
+_names_regex_cache = {}
+
+def get_names_regex(names, flags=0):
+    '''Compile a regex matching any of the names (a tuple), where spaces match any non-word characters (because dicoms often replace spaces by ^). The compiled regexes are cached, since the same names are used for all the files of a subject.'''
+    key = (names, flags)
+    if key not in _names_regex_cache:
+        _names_regex_cache[key] = re.compile('|'.join('(?:%s)' % name.replace(' ', '[\W]+') for name in names), flags)
+    return _names_regex_cache[key]
+
+def find_hidden_name_fields(dcmdata, dcm_pts_names, hidden_name_fields=None):
+    '''From a pydicom object, return all fields where one of the dcm_pts_name (a list) is present.
+    This ease the detection of additional fields where patient name was stored.'''
+    if hidden_name_fields is None:
+        hidden_name_fields = set()
+    # Compile all names in one regex, so that each field is scanned only once
+    names_regex = get_names_regex(tuple(dcm_pts_names))
+    # Convert name to regex friendly (because dicoms often replace spaces by ^)
+    dcm_pts_names = [pts_name.replace(' ', '[\W]+') for pts_name in dcm_pts_names]
+    # Walk through each dicom field
+    for dcmelem in dcmdata:
+        # Skip the fields that cannot store a name (numbers and image data), this avoids lowercasing and scanning the (big) pixel data
+        if dcmelem.VR in NUMERIC_VRS or dcmelem.tag == PIXEL_DATA_TAG:
+            continue
+        dcmfield = dcmelem.tag
+        if dcmelem.value:
+            try:
+                dcmfieldval = dcmelem.value
+                check = False
+                if isinstance(dcmfieldval, list):
+                    dcmfieldval_lower = [s.lower() if isinstance(s, str) else s for s in dcmfieldval]
+                    check = any(pts_name in dcmfieldval_lower for pts_name in dcm_pts_names)
+                elif isinstance(dcmfieldval, (int, float)):
+                    check = False
+                else:
+                    check = names_regex.search(dcmfieldval.lower()) is not None
+                if check:
+                    hidden_name_fields.add(dcmfield)
+            except AttributeError:
+                print('Error with field: %s' % str(dcmfield))
+                raise
+    return hidden_name_fields
+
+def save_dicom_atomically(dcmdata, fullfilepath):
+    """Save a dicom dataset over an existing file without ever leaving a truncated file: the dataset is first written to a temporary file in the same folder, which then replaces the original file"""
+    fd, tmppath = mkstemp(prefix=os.path.basename(fullfilepath) + '.', suffix='.anontmp', dir=os.path.dirname(fullfilepath) or '.')
+    os.close(fd)
+    try:
+        dcmdata.save_as(tmppath)
+        shutil.copymode(fullfilepath, tmppath)  # mkstemp creates the file readable only by the owner, keep the original permissions
+        if os.name == 'nt':
+            # os.rename() cannot overwrite a file on Windows (and os.replace() does not exist in Python 2), the complete data is already in the temporary file at this point
+            os.remove(fullfilepath)
+        os.rename(tmppath, fullfilepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+def anonymize_dicom_file(fullfilepath, pts_name, anon_id, anon_ids, fields_to_del=None, remove_private_tags=False, skip_already_processed=True):
+    '''Anonymize the patient's name in all fields of a dicom file, and save it in place.
+    Returns a status ('anonymized', 'skipped' if already anonymized, 'deleted' for a DICOMDIR file or 'invalid' if not a dicom) and the set of the hidden fields where the name was found.'''
+    hfields = set()
+    try:
+        #TODO: autodetect if name is in filename and change!
+        #print('* Try to read fields from dicom file: %s' % fullfilepath)
+        dcm_pts_name = None
+        # Already anonymized dicom? Peek only at the PatientName field, so that we can skip it without reading the full dicom
+        if skip_already_processed:
+            dcmpeek = read_dcm_patient_name(fullfilepath)
+            if 'PatientName' in dcmpeek:
+                dcm_pts_name = normalize_dcm_name(dcmpeek.PatientName).strip()  # reused below, no need to normalize it again from the full dicom
+                if dcm_pts_name in anon_ids:
+                    return 'skipped', hfields
+            del dcmpeek
+        # Read dicom's file data
+        dcmdata = dicom.read_file(fullfilepath, stop_before_pixels=False)  # need to read the full dicom here since we will modify it, so stop_before_pixels must be False
+        # Store current name (to check at the end if we correctly cleaned up the name)
+        try:
+            if dcm_pts_name is None:
+                dcm_pts_name = normalize_dcm_name(dcmdata.PatientName).strip()
+            # Already anonymized dicom? Get the original patient's name from the anonymized id
+            if dcm_pts_name in anon_ids:
+                dcm_pts_name = anon_ids[dcm_pts_name]
+                if skip_already_processed:
+                    return 'skipped', hfields
+        except AttributeError as exc:
+            filename = os.path.basename(fullfilepath)
+            if filename.upper() == 'DCMDIR' or filename.upper() == 'DICOMDIR':
+                os.remove(fullfilepath)  # DICOMDIR files are useless, they are only descriptive files for CD/DVD of dicoms
+                # DOES NOT WORK: pydicom can read and edit dicomdir files but cannot save them yet!
+                #dcmdata = dicom.read_dicomdir(r'dicoms\ANTOINE_el\EPI_T1\DICOMDIR')
+                #for record in dcmdata.patient_records:
+                    #record.PatientName = anon_id
+                return 'deleted', hfields
+            else:
+                raise
+        # Anonymize
+        dcmdata.PatientName = anon_id
+        dcmdata.PatientID = anon_id
+        if [0x33,0x1013] in dcmdata:  # custom patientname field...
+            dcmdata[0x33,0x1013].value = anon_id
+        # Delete private fields
+        if fields_to_del:
+            for field in fields_to_del:
+                if field in dcmdata:
+                    if isinstance(field, str):
+                        del dcmdata[dcmdata.data_element(field).tag]
+                    else:
+                        del dcmdata[field]
+        if remove_private_tags:
+            dcmdata.remove_private_tags()
+        # Try to anonymize hidden name fields
+        hfields = find_hidden_name_fields(dcmdata, [dcm_pts_name, pts_name], hfields)
+        if hfields:
+            dcm_pts_name_regex = get_names_regex((dcm_pts_name,), re.I)
+            pts_name_regex = get_names_regex((pts_name,), re.I)
+        for dcmfield in hfields:
+            if dcmfield in dcmdata:
+                dcmdata[dcmfield].value = dcm_pts_name_regex.sub(anon_id, dcmdata[dcmfield].value)
+                dcmdata[dcmfield].value = pts_name_regex.sub(anon_id, dcmdata[dcmfield].value)
+        # Last check just in case we could not remove the name everywhere!
+        for elem in dcmdata.iterall():  # walk all fields including nested sequences, but only check those that can store text or short binary values (instead of formatting the whole dataset with str(dcmdata))
+            if (elem.VR in TEXT_VRS or elem.VR in BINARY_VRS) and elem.value:
+                elem_str = normalize_dcm_name(elem.repval)
+                if dcm_pts_name in elem_str or pts_name in elem_str:  # if patient's name is still in the file, that's bad!
+                    print('Hidden name fields found: %s' % hfields)
+                    print('names: %s - %s' %(dcm_pts_name, pts_name))  # debugline
+                    print(str(elem))
+                    raise ValueError('Error: could not remove name totally (there must be an additional non-standard PatientName field) from file: %s' % fullfilepath)
+        # Save anonymized dicom file (atomically, since the file may be interrupted by another worker's error)
+        save_dicom_atomically(dcmdata, fullfilepath)
+        del dcmdata
+        return 'anonymized', hfields
+    except (InvalidDicomError) as exc:
+        return 'invalid', hfields
+    except AttributeError as exc:
+        print(fullfilepath)
+        raise
+
+_anonymize_settings = {}
+
+def _init_anonymize_worker(settings):
+    '''Store the settings shared by all files to anonymize (such as the anon_ids mapping) in the (worker) process, so that they are sent only once per process instead of with each file'''
+    _anonymize_settings.clear()
+    _anonymize_settings.update(settings)
+
+def _anonymize_dicom_file_task(args):
+    '''Anonymize one dicom file given a (fullfilepath, pts_name, anon_id) tuple, with the settings stored by _init_anonymize_worker() (this is a module level function so that it can be used by multiprocessing).
+    Returns the file path along with the result of anonymize_dicom_file(), since the results can be unordered.'''
+    fullfilepath, pts_name, anon_id = args
+    status, hfields = anonymize_dicom_file(fullfilepath, pts_name, anon_id, **_anonymize_settings)
+    return fullfilepath, status, hfields
+
+
+
 #***********************************
 #        GUI AUX FUNCTIONS
 #***********************************
@@ -319,6 +594,16 @@ def check_gui_arg():  # pragma: no cover
     else:
         return True
 
+def positive_int(value):
+    """Argparse type for arguments that must be a strictly positive integer (eg, a number of processes)"""
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not an integer' % value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError('%s is not a strictly positive integer' % value)
+    return ivalue
+
 def AutoGooey(fn):  # pragma: no cover
     """Automatically show a Gooey GUI if --gui is passed as the first argument, else it will just run the function as normal"""
     if check_gui_arg():
@@ -399,6 +684,8 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
                         help='Path to the log file. (Output will be piped to both the stdout and the log file)', **widget_filesave)
     main_parser.add_argument('-v', '--verbose', action='store_true', required=False, default=False,
                         help='Verbose mode (show more output).')
+    main_parser.add_argument('--processes', type=positive_int, required=False, default=None, metavar='N',
+                        help='Number of processes to use to read and anonymize dicom files in parallel (default: number of cpu cores).')
     main_parser.add_argument('--silent', action='store_true', required=False, default=False,
                         help='No console output (but if --log specified, the log will still be saved in the specified file).')
 
@@ -419,6 +706,7 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     anon_permanent_ids = not args.anon_irreversible_ids
     demo_cols_drop = args.dropcols.split(';') if args.dropcols else ['report_path', 'alt_names']
     verbose = args.verbose
+    processes = args.processes
     silent = args.silent
 
     # -- Sanity checks
@@ -464,7 +752,7 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
         if verbose:
             print('Found subjects dicom folders: %s' % ', '.join(subjects_list))
 
-        dcm_subj_list, folder_to_name = get_dcm_names_from_dir(rootpath, verbose=verbose)
+        dcm_subj_list, folder_to_name = get_dcm_names_from_dir(rootpath, verbose=verbose, processes=processes)
         print('Total dicom subjects: %i. Detailed list: %s' % (len(dcm_subj_list), ', '.join(dcm_subj_list)))
 
 
@@ -490,7 +778,7 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
         # Save all extracted fields to a csv file!
         output_file = 'dicom_names.csv'
-        save_dict_as_csv([{'name': name, 'path': path} for name, path in zip(dcm_subj_list, subjects_list + subjects_zip_list)], output_file, csv_order_by='name', verbose=True)
+        save_dict_as_csv([{'name': name, 'path': path} for path, name in folder_to_name.items() if name is not None], output_file, csv_order_by='name', verbose=True)  # one row per folder, so a name can appear several times
         print('Dicom patients names saved to csv file: %s' % output_file)
 
 
@@ -500,8 +788,8 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
 
         # In[ ]:
-        with open("dicom_names.csv") as f:
-            dcm_subj_list = [row['name'] for row in csv.DictReader(f, delimiter=';')]
+        # Use the names list in the same order as in the saved csv (sorted by name), without duplicates (patients with several folders), no need to reload the csv
+        dcm_subj_list = sorted(set(dcm_subj_list))
         print(dcm_subj_list)
 
 
@@ -523,28 +811,26 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
         def clean_name(name):
             '''Clean name from accents and non-alphabetical characters'''
-            return re.sub(r'\W', r'', _unidecode(replace_buggy_accents(name.decode('utf8'), 'utf8')).lower())
+            return replace_buggy_accents(name.decode('utf8'), 'utf8').translate(ascii_alnum_table).encode('ascii')
+        # Letters order, as a dict of ranks computed only once (do not use a plain sorted(), digits would then be placed before letters and all ids would change)
+        alphabet = {letter: rank for rank, letter in enumerate('abcdefghijklmnopqrstuvwxyz1234567890-')}
         def extract_ordered_letters(name):
             '''Order letters composing a name to alphabetical order'''
-            alphabet = list('abcdefghijklmnopqrstuvwxyz1234567890-')
-            return ''.join(sort_list_a_given_list_b(list(clean_name(name)), alphabet))
-        def get_hash(string, algo=None):
+            return ''.join(sort_list_a_given_list_b(clean_name(name), alphabet))
+        def get_hash(string, algo=None, length=None):
+            '''Get the hexadecimal hash of a string, optionally truncated to length characters (only the necessary bytes of the digest are converted to hexadecimal)'''
             if algo is None or algo == 'md5':
-                return hashlib.md5(string).hexdigest()
+                digest = hashlib.md5(string).digest()
             elif algo == 'sha1':
-                return hashlib.md5(string).hexdigest()
+                digest = hashlib.sha1(string).digest()
             else:
                 raise NameError('Hash algorithm not recognized: %s' % algo)
-        def get_ordered_hash(hash_func, string, salt=None, algo=None):
+            if length:
+                return binascii.hexlify(digest[:(length+1)//2])[:length]
+            return binascii.hexlify(digest)
+        def get_ordered_hash(hash_func, string, salt=None, algo=None, length=None):
             '''Get a unique hash insensitive to accents, non-alphabetical characters nor words position switching'''
-            return hash_func(extract_ordered_letters(string+(salt if salt else '')), algo=algo)
-        def get_duplicates(d):
-            seen = set()
-            for k, v in d.items():
-                if v in seen:
-                    yield k, v
-                else:
-                    seen.add(v)
+            return hash_func(extract_ordered_letters(string+(salt if salt else '')), algo=algo, length=length)
 
         # Unit test
         name1 = 'rajaé chatila'
@@ -559,29 +845,26 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
         # Generate unique hashes from each dicom's patient name
         # Generate an anonymized id resilient to spaces and non letters characters and words switching
         # to do that, we take the name, and reorder all letters (and remove any non-letter symbol) by alphabetical order, which gives us simply the ordered sequence of letters composing each name
-        anon_hashes = {name: get_ordered_hash(get_hash, name, anon_salt, algo=anon_hash_algo) for name in dcm_unique}
         # Shortening is an added security, so that if someone tries to bruteforce, there will be missing info to reconstitute the original name that gave this hash (because we are missing parts of the hash, so lots of dissimilar names will have the same shortened hash)
-        if anon_length:
-            for name, h in anon_hashes.items():
-                anon_hashes[name] = anon_hashes[name][:anon_length]
-        # There can be collisions in hashes, then check that there is none
-        anon_dups = dict(get_duplicates(anon_hashes))
+        # There can be collisions in hashes, so we group names per hash in the same pass to check that there is none
+        hash_to_names = defaultdict(list)
+        for name in dcm_unique:
+            hash_to_names[get_ordered_hash(get_hash, name, anon_salt, algo=anon_hash_algo, length=anon_length)].append(name)
+        anon_dups = {h: names for h, names in hash_to_names.items() if len(names) > 1}
         if anon_dups:
-            anon_dups_print = {h: [name for name, h2 in anon_hashes.items() if h2 == h] for h in anon_dups.values()}
-            raise ValueError('Two names have the same id! Please use another hashing algorithm or raise hash length or another salt or turn off anon_permanent_ids. Here is the list of names with same ids: %s' % anon_dups_print)
+            raise ValueError('Two names have the same id! Please use another hashing algorithm or raise hash length or another salt or turn off anon_permanent_ids. Here is the list of names with same ids: %s' % anon_dups)
         del anon_dups
 
-        # Generate the final id (second step)
+        # Generate the final id (second step) and prepend prefix
         if anon_permanent_ids:
             # generate a straightforward id from a shortened hash
-            names_and_ids = anon_hashes
+            anon_ids = {("%s%s" % (anon_prefix, h)): names[0] for h, names in hash_to_names.items()}
         else:
             # generate a unique id based on order (simply the order number when ordered by the hash - since we use the "ordered hash", we get the same properties: the same set of patients names will always generate the same order, and the order cannot be traced back, since it depends both on the hash AND the exact set of patients names to get the exact same order)
             # the big advantage of this approach is that it is nearly impossible to decrypt the original name, since the id gives strictly no information at all
             # the disadvantage is that it is dependent on the subjects names list, so if you add a subject, nearly all ids will change
-            names_and_ids = {name: str(id+1).zfill(anon_length) for id, name in enumerate(sorted(anon_hashes, key=anon_hashes.get))}
-        # Prepend prefix and save the anonymized ids
-        anon_ids = {("%s%s" % (anon_prefix, id)): name for name, id in names_and_ids.items()}
+            anon_ids = {("%s%s" % (anon_prefix, str(id+1).zfill(anon_length))): names[0] for id, (h, names) in enumerate(sorted(hash_to_names.items()))}
+        del hash_to_names
         anon_ids
 
 
@@ -603,8 +886,11 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     with open(demo_csv) as f:
         cf = list(csv.DictReader(f, delimiter=';'))
 
-    with open("dicom_names.csv") as f:
-        dcm_subj_list = [row['name'] for row in csv.DictReader(f, delimiter=';')]
+    if resume:
+        # Load the dicom names from the previous run
+        dcm_subj_list = list(OrderedDict.fromkeys(read_csv_columns("dicom_names.csv", 'name')))  # remove duplicated names (patients with several folders) while keeping order
+        # Load the anonymization map from the previous run
+        anon_ids = dict(read_csv_columns('idtoname.csv', ['id', 'name']))
 
 
     # In[ ]:
@@ -628,11 +914,13 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
     # Disambiguate and clean up csv names
     # Cleanup names
-    for i in range(len(cf)):
-        cf[i]['name'] = cleanup_name(cf[i]['name'])
+    for c in cf:
+        c['name'] = cleanup_name(c['name'])
 
     # Disambiguate (ie, same name with typos or inversed firstname/lastname)
     cf = disambiguate_names(cf, dist_threshold=dist_threshold, verbose=verbose)
+    # Extract the list of names once (in the same order as cf), for the loops that only need the names
+    cf_names = [c['name'] for c in cf]
     # Print list of disambiguated names
     [{c['name']: c['alt_names']} for c in cf if 'alt_names' in c and c['alt_names']]
 
@@ -641,30 +929,21 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
     # Computing distance matrix (ie, finding similar names between dicoms and demographics csv)
     print('Computing distance matrix (finding similar names) between dicoms and demographics, please wait...')
-    dist_matches = {}
-    name_to_anon_ids = {v: k for k, v in anon_ids.items()}
-    for subj in _tqdm(dcm_unique, desc='distmat', unit='subj', file=sys.stdout):
-        found = False
-        for c in cf:
-            if distance.nlevenshtein(subj, c['name'], method=1) <= dist_threshold or distance_jaccard_words_split(subj, c['name'], partial=True, norm=True, dist=dist_threshold) <= dist_threshold: # use shortest distance with normalized levenshtein
-                if subj not in dist_matches:
-                    dist_matches[subj] = []
-                dist_matches[subj].append(c['name'])
-                found = True
-        if not found:
-            dist_matches[subj] = None
+    name_to_anon_ids = {v: k for k, v in anon_ids.items()}  # computed once, anon_ids is final here (either generated above or loaded from idtoname.csv)
+    # Compare only the unique csv names (several rows can have the same name after cleanup and disambiguation), the matches are names so the results are the same
+    dist_matches = dist_matrix(dcm_unique, list(OrderedDict.fromkeys(cf_names)), dist_threshold=dist_threshold, progress=True)
 
-    # Remove duplicate values (ie, csv names)
-    dist_matches = {k: (list(set(v)) if v else v) for k, v in dist_matches.items()}
+    # Remove duplicate values (ie, csv names), keeping the order of the matches
+    dist_matches = {k: (list(OrderedDict.fromkeys(v)) if v else v) for k, v in dist_matches.items()}
     # Find missing subjects (ie, dicom name present but missing in csv database)
-    missing_subj = {k: v for k, v in dist_matches.items() if not v}
+    missing_subj = set(k for k, v in dist_matches.items() if not v)
     # Print results
     if not missing_subj:
         print('No missing subject, congratulations!')
     else:
-        print('Missing subjects from csv database (saved in missing_demo.csv): %i, names: %s' % (len(missing_subj), ', '.join(sorted(missing_subj.keys()))))
-        save_dict_as_csv([{'name': msubj, 'id': name_to_anon_ids[msubj]} for msubj in missing_subj.keys()], 'missing_demo.csv', fields_order=['name', 'id'], csv_order_by='name', verbose=False)
-        save_dict_as_csv([{'id': name_to_anon_ids[msubj]} for msubj in missing_subj.keys()], 'missing_demo_anonymized.csv', fields_order=['id'], csv_order_by='id', verbose=False)
+        print('Missing subjects from csv database (saved in missing_demo.csv): %i, names: %s' % (len(missing_subj), ', '.join(sorted(missing_subj))))
+        save_dict_as_csv([{'name': msubj, 'id': name_to_anon_ids[msubj]} for msubj in missing_subj], 'missing_demo.csv', fields_order=['name', 'id'], csv_order_by='name', verbose=False)
+        save_dict_as_csv([{'id': name_to_anon_ids[msubj]} for msubj in missing_subj], 'missing_demo_anonymized.csv', fields_order=['id'], csv_order_by='id', verbose=False)
 
     print('\nList of all matches (dicom : csv):')
     print(dist_matches)
@@ -680,30 +959,13 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
                 csvname_to_uniquename[csv_name] = uniquename
 
 
-    # In[ ]:
-
-    def flatten_gen(L):
-        for item in L:
-            if isinstance(item, list):
-                for i in flatten(item):
-                    yield i
-            else:
-                yield item
-
-    def flatten(L):
-        return list(flatten_gen(L))
-
-    def get_unique_names(L):
-        return filter(None, set(L))
-
-
     # In[ ]:
 
     demo_short_csv = 'demographics_shortened.csv'
     # Get unique demo csv names (which matched with dicom in the distance matrix)
-    demo_names = get_unique_names(flatten(dist_matches.values()))
+    demo_names = set(filter(None, itertools.chain.from_iterable(v for v in dist_matches.values() if v)))
     # Shorten demographics to only names present in dicoms
-    cf_short = [c for c in cf if c['name'] in demo_names]
+    cf_short = [c for c, name in itertools.izip(cf, cf_names) if name in demo_names]
     # Save shortened demographics
     save_dict_as_csv(cf_short, demo_short_csv, fields_order=['name'], csv_order_by='name', verbose=False)
     print('Shortened demographics (to only the dicoms available) were saved to %s.' % demo_short_csv)
@@ -718,15 +980,7 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     # ## Anonymizing demographics csv
 
     # In[ ]:
-    with open('idtoname.csv', mode='r') as f:
-        reader = csv.DictReader(f, delimiter=';')
-        anon_ids = {row['id']: row['name'] for row in reader}
     anon_ids
-
-
-    # In[ ]:
-
-    name_to_anon_ids = {v: k for k, v in anon_ids.items()}
     name_to_anon_ids
 
 
@@ -795,35 +1049,6 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     # Note: this will anonymize only the dicoms fields (name of patient, whatever field it is found in).
     # If there are any other file containing the patient's name (such as .txt, .csv, .xls, etc), the files might be deleted if you want (add the extension in the list) or they will stay.
     #from dicom.filebase import DicomFileLike  # fix for IOError access denied, see https://github.com/darcymason/pydicom/issues/69
-    def find_hidden_name_fields(dcmdata, dcm_pts_names, hidden_name_fields=None):
-        '''From a pydicom object, return all fields where one of the dcm_pts_name (a list) is present.
-        This ease the detection of additional fields where patient name was stored.'''
-        if hidden_name_fields is None:
-            hidden_name_fields = set()
-        # Convert name to regex friendly (because dicoms often replace spaces by ^)
-        dcm_pts_names = [pts_name.replace(' ', '[\W]+') for pts_name in dcm_pts_names]
-        # Walk through each dicom field
-        for dcmfield in dcmdata.keys(): # different from dir()?
-            if dcmdata[dcmfield]:
-                try:
-                    #dcmfieldval = dcmdata.data_element(dcmfield).value
-                    dcmfieldval = dcmdata[dcmfield].value
-                    check = False
-                    if isinstance(dcmfieldval, list):
-                        dcmfieldval_lower = [s.lower() if isinstance(s, str) else s for s in dcmfieldval]
-                        check = any(pts_name in dcmfieldval_lower for pts_name in dcm_pts_names)
-                    elif isinstance(dcmfieldval, (int, float)):
-                        check = False
-                    else:
-                        check = any(re.search(pts_name, dcmfieldval.lower()) for pts_name in dcm_pts_names)
-                    if check:
-                        hidden_name_fields.add(dcmfield)
-                except AttributeError:
-                    print('Error with field: %s' % str(dcmfield))
-                    raise
-        return hidden_name_fields
-
-
     reports_delete = True  # delete pdf/doc/docx/txt files automatically?
     skip_already_processed = True
     remove_private_tags = False
@@ -839,19 +1064,22 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     # Init path and 1st level folders list
     uni_rootpath = unicode(rootpath, 'latin1')  # convert rootpath to unicode before walking with os.listdir and recwalk, so we get back unicode strings too (else we won't be able to enter folders with accentuated characters)
     subjects_list = get_list_of_folders(uni_rootpath)
-    # Precompute total number of files (for progressbar)
+    # Precompute total number of files (for progressbar), and store the list of files to avoid walking again
     print('Precomputing total number of files, please wait...')
+    subject_files = {}
     for subject in _tqdm(subjects_list, unit='folders', desc='PRECOMP', file=sys.stdout):
         fullpath = os.path.join(uni_rootpath, subject)
-        for dirpath, filename in recwalk(fullpath, topdown=False, folders=True):
-            count_files += 1
+        subject_files[subject] = list(recwalk(fullpath, sorting=True, topdown=False, folders=True))
+        count_files += len(subject_files[subject])
     # Get folder_to_name mapping
-    _, folder_to_name = get_dcm_names_from_dir(uni_rootpath)
+    _, folder_to_name = get_dcm_names_from_dir(uni_rootpath, processes=processes)
     _, folder_to_name = get_dcm_names_from_zip(uni_rootpath, folder_to_name=folder_to_name)
-    # Loop through each subject root directory to rewrite dicoms
+    # Loop through each subject root directory to list the dicoms to rewrite
     print('Launching anonymization of dicoms fields, please wait...')
     tbar = _tqdm(total=count_files, unit='files', desc='ANON', file=sys.stdout)
     hfields = set()
+    anon_tasks = []
+    deleted_files = set()  # files deleted during the anonymization, to update the files lists afterwards
     for folder in subjects_list:
         # Already processed folder and there are several sessions, extract the id from folder name
         subject = folder
@@ -863,10 +1091,7 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
         if subject in anon_ids:
             pts_name = anon_ids[subject]
             if skip_already_processed:
-                fullpath = os.path.join(uni_rootpath, folder)
-                c = 0
-                for _, _ in recwalk(fullpath, topdown=False, folders=True):
-                    c += 1
+                c = len(subject_files[folder])
                 tbar.update(c)
                 count_files_skipped += c
                 continue
@@ -882,86 +1107,49 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
         anon_id = name_to_anon_ids[dcmname_to_uniquename[pts_name]]
         if verbose:
             print('- Processing subject %s -> %s in folder %s' % (pts_name, anon_id, folder))
-        #fullpath = unicode(os.path.join(rootpath, folder), 'latin1')
-        fullpath = os.path.join(uni_rootpath, folder)  # no need to use unicode(str, 'latin1') here because rootpath and folder were both converted to unicode before
-        # Loop through each subfiles and subfolders for this subject (we assume all dicoms are for one subject, so we rename them all to this subject)
-        for dirpath, filename in recwalk(fullpath, topdown=False, folders=True):
+        # Loop through each subfiles and subfolders for this subject, listed in the precompute pass (we assume all dicoms are for one subject, so we rename them all to this subject)
+        for dirpath, filename in subject_files[folder]:
             fullfilepath = os.path.join(dirpath, filename)
             # Report file: delete if option enabled
             if reports_delete and filename.endswith( ('pdf', 'doc', 'docx', 'txt', 'csv', 'xls', 'xlsx') ):
                 os.remove(fullfilepath)
+                deleted_files.add(fullfilepath)
                 count_delete += 1
                 continue
             elif os.path.isdir(fullfilepath):  # else we get an IOError...
                 continue
             else:
-                # Dicom file: change PatientName field
-                try:
-                    #TODO: autodetect if name is in filename and change!
-                    #print('* Try to read fields from dicom file: %s' % os.path.join(dirpath, filename))
-                    # Read dicom's file data
-                    #os_id = os.open(str(fullfilepath), os.O_BINARY | os.O_RDONLY)
-                    #fd = os.fdopen(os_id)
-                    #dcmdata = dicom.read_file(DicomFileLike(fd), stop_before_pixels=False)
-                    dcmdata = dicom.read_file(fullfilepath, stop_before_pixels=False)  # need to read the full dicom here since we will modify it, so stop_before_pixels must be False
-                    # Store current name (to check at the end if we correctly cleaned up the name)
-                    try:
-                        dcm_pts_name = _unidecode(dcmdata.PatientName.decode('latin1').replace('^', ' ')).lower().strip()
-                        # Already anonymized dicom? Get the original patient's name from the anonymized id
-                        if dcm_pts_name in anon_ids:
-                            dcm_pts_name = anon_ids[dcm_pts_name]
-                            if skip_already_processed:
-                                tbar.update()
-                                continue
-                    except AttributeError as exc:
-                        if filename.upper() == 'DCMDIR' or filename.upper() == 'DICOMDIR':
-                            os.remove(fullfilepath)  # DICOMDIR files are useless, they are only descriptive files for CD/DVD of dicoms
-                            # DOES NOT WORK: pydicom can read and edit dicomdir files but cannot save them yet!
-                            #dcmdata = dicom.read_dicomdir(r'dicoms\ANTOINE_el\EPI_T1\DICOMDIR')
-                            #for record in dcmdata.patient_records:
-                                #record.PatientName = anon_id
-                            continue
-                        else:
-                            raise
-                    # Anonymize
-                    dcmdata.PatientName = anon_id
-                    dcmdata.PatientID = anon_id
-                    if [0x33,0x1013] in dcmdata:  # custom patientname field...
-                        dcmdata[0x33,0x1013].value = anon_id
-                    # Delete private fields
-                    for field in fields_to_del:
-                        if field in dcmdata:
-                            if isinstance(field, str):
-                                del dcmdata[dcmdata.data_element(field).tag]
-                            else:
-                                del dcmdata[field]
-                    if remove_private_tags:
-                        dcmdata.remove_private_tags()
-                    # Try to anonymize hidden name fields
-                    hfields = find_hidden_name_fields(dcmdata, [dcm_pts_name, pts_name], hfields)
-                    for dcmfield in hfields:
-                        if dcmfield in dcmdata:
-                            dcmdata[dcmfield].value = re.sub(dcm_pts_name.replace(' ', '[\W]+'), anon_id, dcmdata[dcmfield].value, flags=re.I)
-                            dcmdata[dcmfield].value = re.sub(pts_name.replace(' ', '[\W]+'), anon_id, dcmdata[dcmfield].value, flags=re.I)
-                    # Last check just in case we could not remove the name everywhere!
-                    dcm_data_str = _unidecode(str(dcmdata).decode('latin1').replace('^', ' ')).lower().strip()  # read all fields at once
-                    if dcm_pts_name in str(dcm_data_str) or pts_name in str(dcm_data_str):  # if patient's name is still in the file, that's bad!
-                        print('Hidden name fields found: %s' % hfields)
-                        print('names: %s - %s' %(dcm_pts_name, pts_name))  # debugline
-                        print(str(dcm_data_str))
-                        raise ValueError('Error: could not remove name totally (there must be an additional non-standard PatientName field) from file: %s' % fullfilepath)
-                    # Save anonymized dicom file
-                    dcmdata.save_as(fullfilepath)
-                    # Close the dicom file
-                    #os.close(os_id)
-                    del dcmdata
-                    count_anon += 1
-                except (InvalidDicomError) as exc:
-                    pass
-                except AttributeError as exc:
-                    print(fullfilepath)
-                    raise
-            tbar.update()  # update progressbar
+                # Dicom file: will change PatientName field
+                anon_tasks.append( (fullfilepath, pts_name, anon_id) )
+    # Anonymize the dicom files in parallel (each file is independent, the hidden name fields found in each file are merged at the end)
+    anon_settings = {'anon_ids': anon_ids, 'fields_to_del': fields_to_del, 'remove_private_tags': remove_private_tags, 'skip_already_processed': skip_already_processed}
+    if processes == 1 or len(anon_tasks) <= 1:
+        _init_anonymize_worker(anon_settings)
+        anon_results = itertools.imap(_anonymize_dicom_file_task, anon_tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, _init_anonymize_worker, (anon_settings,))
+        anon_results = pool.imap_unordered(_anonymize_dicom_file_task, anon_tasks, chunksize=32)
+    try:
+        for fullfilepath, status, file_hfields in anon_results:
+            hfields.update(file_hfields)
+            if status == 'anonymized':
+                count_anon += 1
+            if status != 'deleted':
+                tbar.update()  # update progressbar
+            else:
+                deleted_files.add(fullfilepath)
+    except BaseException:
+        # stop all the workers at the first error (files are saved atomically, so killing a worker cannot leave a truncated dicom)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     tbar.close()
 
     print('Hidden name fields found (and automagically anonymized): %s' % hfields)
@@ -973,44 +1161,51 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     # Rename files if filename include a patient's name
 
     # Compile regex to find any patient name (of any patient!) in a string. Non-alphabetical characters are ignored.
-    filename_patterns = re.compile('(' + '|'.join(re.sub('[^a-zA-Z]+', '[^a-zA-Z]*', s) for s in dcm_unique) + ')', flags=re.I)
-
-    uni_rootpath = unicode(rootpath, 'latin1')  # convert rootpath to unicode before walking with os.listdir and recwalk, so we get back unicode strings too (else we won't be able to enter folders with accentuated characters)
-    subjects_list = get_list_of_folders(uni_rootpath)
+    filename_patterns = re.compile('(' + '|'.join(NONLETTERS_REGEX.sub('[^a-zA-Z]*', s) for s in dcm_unique) + ')', flags=re.I)
+    # Letters of each name: a filename can only match filename_patterns if its letters contain the letters of a name, which is much faster to check than the regex
+    names_letters = set(NONLETTERS_REGEX.sub('', s.lower()) for s in dcm_unique)
 
+    # Reuse the lists of files of the anonymization pass (the subjects folders were not renamed yet), without the deleted files, instead of walking again
     count_files = 0
-    # Precompute total number of files (for progressbar)
-    print('Precomputing total number of files, please wait...')
-    for subject in _tqdm(subjects_list, unit='folders', desc='PRECOMP', file=sys.stdout):
-        fullpath = os.path.join(uni_rootpath, subject)
-        for dirpath, filename in recwalk(fullpath, topdown=False, folders=True):
-            count_files += 1
+    for subject in subjects_list:
+        subject_files[subject] = [(dirpath, filename) for dirpath, filename in subject_files[subject] if os.path.join(dirpath, filename) not in deleted_files]
+        count_files += len(subject_files[subject])
 
     # Rename files if they have a patient's name
     count_moved = 0
+    dcm_unique_index = NamesIndex(dcm_unique)  # precompute once the data to match names found in filenames
+    renames = []  # renames are done after the walk, in the same (bottom-up) order, so that files are renamed before their parent folders
+    filename_name_to_anon_id = {}  # cache of the anonymized id for each name found in filenames, since the same name is usually found in all the files of a subject
     tbar = _tqdm(total=count_files, unit='files', desc='ANONFN', file=sys.stdout)
     print('Anonymizing of file/folder names, please wait...')
     for folder in subjects_list:  # do not rename the top directories, this will be done separately
         if verbose:
             print('- Processing top folder %s' % (folder))
-        fullpath = os.path.join(uni_rootpath, folder)
-        for dirpath, filename in recwalk(fullpath, topdown=False, folders=True):
+        for dirpath, filename in subject_files[folder]:
             # Find any name (of any patient) in the filename
             # TODO: construct re all permutations of all names, and re.compile, it will be fast
             # TODO: try to do levenshtein distance on names? (but just with current patient name, else it will take too much time with all patients...) it will considerably slow down the anonymization... Is there a faster way?
-            matchs = filename_patterns.finditer(filename)
+            filename_letters = NONLETTERS_REGEX.sub('', filename.lower())
+            if any(name_letters in filename_letters for name_letters in names_letters):
+                matchs = filename_patterns.finditer(filename)
+            else:
+                matchs = []
             # If found, we find the anonymized id for each match to replace
             to_replace = []
             for m in matchs:
                 # Clean up the name
-                pts_name_in_filename = re.sub('[^a-zA-Z]+', ' ', m.group(1).lower())
-                # Find the closest unique name
-                dst_mat = dist_matrix([pts_name_in_filename], dcm_unique)
-                # Get the anonymized id from unique name
-                if dst_mat[pts_name_in_filename]:
-                    anon_id = name_to_anon_ids[dst_mat[pts_name_in_filename][0]]
-                else:  # could not find an id, just anonymize with a random name
-                    anon_id = 'anon'
+                pts_name_in_filename = NONLETTERS_REGEX.sub(' ', m.group(1).lower())
+                if pts_name_in_filename in filename_name_to_anon_id:
+                    anon_id = filename_name_to_anon_id[pts_name_in_filename]
+                else:
+                    # Find the closest unique name
+                    dst_mat = dist_matrix([pts_name_in_filename], dcm_unique_index)
+                    # Get the anonymized id from unique name
+                    if dst_mat[pts_name_in_filename]:
+                        anon_id = name_to_anon_ids[dst_mat[pts_name_in_filename][0]]
+                    else:  # could not find an id, just anonymize with a random name
+                        anon_id = 'anon'
+                    filename_name_to_anon_id[pts_name_in_filename] = anon_id
                 # Add slide index and anonymized id to replace all at once later
                 to_replace.append( ( anon_id, slice(m.start(1), m.end(1)) ) )
             # Replace all matchs at once
@@ -1022,11 +1217,13 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
                     filename_anon[slidx] = anon_id
                 # Convert back to a string
                 filename_anon = ''.join(filename_anon)
-                # Rename the file/folder
-                shutil.move(os.path.join(dirpath, filename), os.path.join(dirpath, filename_anon))
-                count_moved += 1
+                # Rename the file/folder (later, after the walk)
+                renames.append( (os.path.join(dirpath, filename), os.path.join(dirpath, filename_anon)) )
             tbar.update()
     tbar.close()
+    for src, dst in renames:
+        os.rename(src, dst)  # same directory, so no need for shutil.move()
+        count_moved += 1
     print('Total dicom files/folders moved: %i over %i total.' % (count_moved, count_files))
 
 
@@ -1044,6 +1241,11 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
         print('Launching anonymization of dicom folders, please wait...')
         # Get list of folders
         subjects_list = get_list_of_folders(uni_rootpath)
+        folder_renames = []  # renames are done after the loop
+        new_folder_names = set()  # new names of the folders to rename, to avoid name clashes before the folders are renamed
+        old_folder_names = set()  # folders that will already be renamed away when the next renames are applied (renames are applied in order), so their names are free
+        def folder_name_taken(path):
+            return path in new_folder_names or (path not in old_folder_names and os.path.exists(path))
         for subject in _tqdm(subjects_list, unit='folder', desc='RENAME', file=sys.stdout):
             # Already anonymized folder, just skip
             if subject in anon_ids or re.match('(^%s.+)_s\d+$' % anon_prefix, subject):
@@ -1069,16 +1271,22 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
             fullpath = os.path.join(uni_rootpath, subject)
             # Rename subject directory
             new_folder_name = os.path.join(uni_rootpath, anon_id)
-            if not os.path.exists(new_folder_name):
-                os.rename(fullpath, new_folder_name)
+            if not folder_name_taken(new_folder_name):
+                folder_renames.append( (fullpath, new_folder_name) )
+                new_folder_names.add(new_folder_name)
+                old_folder_names.add(fullpath)
             else:
                 # if new folder already exists, find a new name (append "_sx" where x is a number)
                 for i in range(2, 1000):
                     alt_folder_name = "%s_s%i" % (new_folder_name, i)
-                    if not os.path.exists(alt_folder_name):
-                        os.rename(fullpath, alt_folder_name)
+                    if not folder_name_taken(alt_folder_name):
+                        folder_renames.append( (fullpath, alt_folder_name) )
+                        new_folder_names.add(alt_folder_name)
+                        old_folder_names.add(fullpath)
                         break
             count_folder += 1
+        for src, dst in folder_renames:
+            os.rename(src, dst)
 
     print('Total dicom folders renamed (anonymized): %i over %i total. Skipped: %i. Empty folders (or containing non-dicom files) and thus deleted: %i.' % (count_folder, len(subjects_list), count_skipped, count_empty))
 
@@ -1090,14 +1298,10 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
     with open(demo_anon_csv) as f:
         cf_anon = list(csv.DictReader(f, delimiter=';'))
     # Get list of anonymized dicom names
-    dcm_ids, _ = get_dcm_names_from_dir(rootpath)
-    # Shorten anonymized demographics to only the ids present in dicoms
-    for rowid in range(len(cf_anon)):
-        if cf_anon[rowid]['name'] not in dcm_ids:
-            del cf_anon[rowid]
-            for col in demo_cols_drop:
-                if col in cf_anon[rowid]:
-                    del cf_anon[rowid][col]
+    dcm_ids, _ = get_dcm_names_from_dir(rootpath, processes=processes)
+    dcm_ids = set(dcm_ids)
+    # Shorten anonymized demographics to only the ids present in dicoms (the names read from dicoms are cleaned up, so the ids must be too), and drop the columns that might give away subjects infos
+    cf_anon = [{k: v for k, v in row.items() if k not in demo_cols_drop} for row in cf_anon if cleanup_name(row['name']) in dcm_ids]
     # Save anonymized demographics
     demo_anon_short_csv = 'demographics_anonymized_shortened.csv'
     save_dict_as_csv(cf_anon, demo_anon_short_csv, fields_order=['name'], csv_order_by='name', verbose=False)
@@ -1125,4 +1329,5 @@ Note: use --cmd to avoid launching the graphical interface and use as a commandl
 
 # Calling main function if the script is directly called (not imported as a library in another program)
 if __name__ == "__main__":  # pragma: no cover
+    multiprocessing.freeze_support()  # necessary for multiprocessing to work in a frozen (pyinstaller) executable on Windows
     sys.exit(main())
@@ -8,15 +8,22 @@
 
 from __future__ import absolute_import
 
+import codecs
 import csv
+import operator
 import os
 import re
+import sys
 from .distance import distance
 
 try:
-    from scandir import walk # use the faster scandir module if available (Python >= 3.5), see https://github.com/benhoyt/scandir
+    from scandir import scandir, walk # use the faster scandir module if available (for Python < 3.5), see https://github.com/benhoyt/scandir
 except ImportError as exc:
-    from os import walk # else, default to os.walk()
+    from os import walk # os.walk() is based on scandir() in Python >= 3.5
+    try:
+        from os import scandir # Python >= 3.5
+    except ImportError as exc:
+        scandir = None # else, walk_files() will fallback to recwalk()
 
 try:
     # to convert unicode accentuated strings to ascii
@@ -38,6 +45,23 @@ except ImportError as exc:
             return args[0]
         return kwargs.get('iterable', None)
 
+try:
+    # native (C++ with SIMD) levenshtein implementation, much faster than the bundled pure python distance module, see https://github.com/maxbachmann/RapidFuzz
+    # rapidfuzz does not support Python 2, so this only applies when these functions are used from Python 3
+    from rapidfuzz.distance import Levenshtein as _rf_levenshtein
+    from rapidfuzz import process as _rf_process
+except ImportError as exc:
+    _rf_levenshtein = None
+    _rf_process = None
+
+_cdistance = hasattr(distance, 'cdistance')  # is the compiled C implementation of the distance module available?
+
+# Precompiled regular expressions
+WORDSPLIT_REGEX = re.compile(r'-+|\s+|,+|\.+|/+')
+WORDSEP_REGEX = re.compile(r'[-\s,./]')
+NONALNUM_REGEX = re.compile('[^a-zA-Z0-9\-]+')
+DASHES_REGEX = re.compile('\-+')
+
 def save_dict_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbose=False):
     """Save a dict/list of dictionaries in a csv, with each key being a column"""
     # Define CSV fields order
@@ -51,9 +75,8 @@ def save_dict_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbo
         dvals = d
     # dict is empty, maybe no match was found? Then we just save an empty csv
     if not dvals:
-        with open(output_file, 'wb') as f:
-            f.write('')
-        return
+        open(output_file, 'w').close()  # create or truncate the file, writing '' in a binary file fails on Python 3
+        return True
     # Then automatically add any other field (which order we don't care, they will be appended in alphabetical order)
     fields_order_check = set(fields_order)
     for missing_field in sorted(dvals[0]):
@@ -62,21 +85,45 @@ def save_dict_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbo
     if verbose:
         print('CSV fields order: '+str(fields_order))
 
-    # Write the csv
-    with open(output_file, 'wb') as f:  # Just use 'w' mode in 3.x
+    # Write the csv (with a big buffer so that rows are flushed to disk in a few big writes)
+    if sys.version_info[0] >= 3:
+        f = open(output_file, 'w', 1<<20, newline='')  # csv module needs text mode without newlines translation in 3.x
+    else:
+        f = open(output_file, 'wb', 1<<20)
+    with f:
         w = csv.DictWriter(f, fields_order, delimiter=';')
         w.writeheader()
         # Reorder by name (or by any other column)
         if csv_order_by is not None:
-            d_generator = sorted(dvals, key=lambda x: x[csv_order_by])
+            d_generator = sorted(dvals, key=operator.itemgetter(csv_order_by))  # itemgetter is implemented in C, faster than a lambda
         else:
             d_generator = dvals
-        # Walk the ordered list of dicts and write each as a row in the csv!
-        for d_fields in d_generator:
-            w.writerow(d_fields)
+        # Write all the rows at once (the loop is done by the csv module)
+        w.writerows(d_generator)
     return True
 
 
+def read_csv_columns(filepath, columns, delimiter=';'):
+    """Read only the specified column(s) of a csv file, without building a dict for each row like csv.DictReader does.
+    This is a generator of the column values if columns is a single column name, or of tuples of values if columns is a list of columns names."""
+    with open(filepath) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if header is None:
+            # empty csv
+            return
+        if isinstance(columns, (list, tuple)):
+            cols_idx = [header.index(col) for col in columns]
+            for row in reader:
+                if row:  # skip empty rows like csv.DictReader
+                    yield tuple(row[idx] for idx in cols_idx)
+        else:
+            col_idx = header.index(columns)
+            for row in reader:
+                if row:
+                    yield row[col_idx]
+
+
 def save_df_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbose=False):
     """Save a dataframe in a csv"""
     # Define CSV fields order
@@ -96,25 +143,159 @@ def save_df_as_csv(d, output_file, fields_order=None, csv_order_by=None, verbose
     return True
 
 
-def distance_jaccard_words(seq1, seq2, partial=True, norm=False, dist=0, minlength=0):
-    """Jaccard distance on two lists of words. Any permutation is tested, so the resulting distance is insensitive to words order."""
-    # The goal was to have a distance on words that 1- is insensible to permutation ; 2- returns 0.2 or less if only one or two words are different, except if one of the lists has only one entry! ; 3- insensible to shortened name ; 4- allow for similar but not totally exact words.
-    seq1_c = filter(None, list(seq1))
-    seq2_c = filter(None, list(seq2))
-    count_total = len(seq1_c) + len(seq2_c)
+def get_levenshtein_masks(s):
+    """Get the characters bitmasks of a string for levenshtein_bitparallel(): bit i of the mask of a character is set if s[i] is this character"""
+    peq = {}
+    for i, ch in enumerate(s):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    return peq
+
+def levenshtein_bitparallel(s1, s2, peq1=None, max_dist=None):
+    """Levenshtein distance with Myers/Hyyro bit-parallel algorithm: each column of the dynamic programming matrix is encoded as bit vectors, so that it is updated with a few bitwise operations instead of one operation per cell.
+    Bit vectors are Python integers, so there is no limit on the strings lengths. peq1 can be the precomputed get_levenshtein_masks(s1), to reuse it when s1 is compared to lots of strings.
+    If max_dist is set, the computation stops as soon as the distance is sure to be above max_dist, and max_dist + 1 is returned."""
+    m = len(s1)
+    n = len(s2)
+    if not m:
+        return n
+    if peq1 is None:
+        peq1 = get_levenshtein_masks(s1)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    vp = full  # vertical positive deltas
+    vn = 0  # vertical negative deltas
+    score = m
+    if max_dist is None:
+        max_dist = max(m, n)  # the distance can never be above the length of the longest string
+    # the score can decrease by at most one per remaining character of s2, so we can stop when score - (n - j) > max_dist
+    cutoff = max_dist + n
+    for j, ch in enumerate(s2, 1):
+        eq = peq1.get(ch, 0)
+        xv = eq | vn
+        xh = (((eq & vp) + vp) ^ vp) | eq
+        hp = vn | (~(xh | vp) & full)  # horizontal positive deltas
+        hn = vp & xh  # horizontal negative deltas
+        if hp & last:
+            score += 1
+        elif hn & last:
+            score -= 1
+        hp = ((hp << 1) | 1) & full
+        hn = (hn << 1) & full
+        vp = hn | (~(xv | hp) & full)
+        vn = hp & xv
+        if score + j > cutoff:
+            return max_dist + 1
+    return score
+
+def nlevenshtein(s1, s2):
+    """Normalized levenshtein distance (edit distance divided by the length of the longest string, same as distance.nlevenshtein(method=1)), computed in native code by rapidfuzz or by the compiled distance module if available, else with the bit-parallel algorithm"""
+    if _rf_levenshtein is not None:
+        return _rf_levenshtein.normalized_distance(s1, s2)
+    if _cdistance:
+        return distance.nlevenshtein(s1, s2, method=1)
+    if s1 == s2:
+        return 0.0
+    len1, len2 = len(s1), len(s2)
+    if len1 < len2:
+        # use the shortest string as the bit vectors
+        s1, s2 = s2, s1
+        len1, len2 = len2, len1
+    return levenshtein_bitparallel(s2, s1) / float(len1)
+
+def get_chars_mask(s):
+    """Get a 64 bits mask of the characters present in a string (each character sets the bit of its code modulo 64)"""
+    mask = 0
+    for ch in set(s):
+        mask |= 1 << (ord(ch) & 63)
+    return mask
+
+def get_max_edits(dist, maxlen):
+    """Get the maximum number of edits for a normalized levenshtein distance below or equal to dist between strings of maximum length maxlen (-1 if none is possible)"""
+    max_dist = int(dist * maxlen)
+    # fix floating point rounding, so that we get exactly the same result as comparing the normalized distance with dist
+    while max_dist < maxlen and float(max_dist + 1) / maxlen <= dist:
+        max_dist += 1
+    while max_dist >= 0 and float(max_dist) / maxlen > dist:
+        max_dist -= 1
+    return max_dist
+
+def nlevenshtein_leq(s1, s2, dist, mask1=None, mask2=None, peq1=None):
+    """Check if the normalized levenshtein distance of two strings is below or equal to dist.
+    Cheap lower bounds of the edit distance are checked first to skip the full computation for most dissimilar pairs: the difference of lengths, and half the number of characters present in only one of the strings (using the characters masks, which can be precomputed with get_chars_mask()).
+    peq1 can be the precomputed get_levenshtein_masks(s1), shared by all the comparisons of s1 in the pure python path."""
+    maxlen = max(len(s1), len(s2))
+    if not maxlen:
+        return True
+    if float(abs(len(s1) - len(s2))) / maxlen > dist:
+        return False
+    # Bounded computation: stop as soon as the number of edits is above the maximum allowed by dist
+    max_dist = get_max_edits(dist, maxlen)
+    if max_dist < 0:
+        return False
+    if _rf_levenshtein is not None:
+        # rapidfuzz is bit-parallel in native code with an early exit at max_dist, this is faster than checking the characters masks in python
+        return _rf_levenshtein.distance(s1, s2, score_cutoff=max_dist) <= max_dist
+    if mask1 is None:
+        mask1 = get_chars_mask(s1)
+    if mask2 is None:
+        mask2 = get_chars_mask(s2)
+    # each edit can at most remove one character missing from the other string and add one, so we need at least half as many edits as characters present in only one string
+    if (bin(mask1 ^ mask2).count('1') + 1) // 2 > max_dist:
+        return False
+    if _cdistance:
+        return nlevenshtein(s1, s2) <= dist
+    if s1 == s2:
+        return True
+    if peq1 is None and len(s1) > len(s2):
+        # use the shortest string as the bit vectors
+        s1, s2 = s2, s1
+    return levenshtein_bitparallel(s1, s2, peq1, max_dist=max_dist) <= max_dist
+
+def nlevenshtein_extract(s, choices, dist, masks=None):
+    """Get the set of the indices of the choices which normalized levenshtein distance to s is below or equal to dist.
+    If rapidfuzz is available, all choices are compared in a single native call, else each choice is checked with nlevenshtein_leq() (masks can be the precomputed characters masks of the choices)."""
+    if _rf_process is not None:
+        # processor=None: do not lowercase nor strip the strings (the default processor of rapidfuzz < 3.0), to get the same distances as nlevenshtein()
+        # rapidfuzz converts the normalized cutoff to a number of edits with floating point rounding, which can discard the pairs exactly at dist, so we use a slightly looser cutoff and check the exact scores
+        return set(idx for _, score, idx in _rf_process.extract(s, choices, scorer=_rf_levenshtein.normalized_distance, processor=None, score_cutoff=min(dist + 1e-6, 1.0), limit=None) if score <= dist)
+    mask = get_chars_mask(s)
+    peq = get_levenshtein_masks(s)  # the bit vectors of s are computed once for all choices
+    if masks is None:
+        masks = [get_chars_mask(c) for c in choices]
+    return set(idx for idx, c in enumerate(choices) if nlevenshtein_leq(s, c, dist, mask, masks[idx], peq))
+
+def _distance_jaccard_words_count(seq1_c, seq2_c, partial, dist, minlength):
+    """Count the words of seq1_c equal (or similar) to a word of seq2_c, each word of seq2_c being matched at most once. seq1_c and seq2_c must not contain empty words, and the words of seq1_c shorter than minlength must already be removed."""
     count_eq = 0
+    used = bytearray(len(seq2_c))  # words of seq2 already matched (instead of deleting them from the list, which shifts all the following items)
+    if minlength:
+        # Words shorter than minlength can never match, so mark them as used once here instead of checking each pair in the inner loop
+        for skey, s2 in enumerate(seq2_c):
+            if len(s2) < minlength:
+                used[skey] = 1
+    count_free = len(seq2_c) - sum(used)  # number of words of seq2 that can still be matched
+    leq = nlevenshtein_leq  # local binding, avoids a global lookup per pair
     for s1 in seq1_c:
-        flag_eq = False
+        if not count_free:
+            # all the words of seq2 were matched, the remaining words of seq1 cannot match anything
+            break
+        s1_startswith = s1.startswith
+        len1 = len(s1)
         for skey, s2 in enumerate(seq2_c):
-            if minlength and (len(s1) < minlength or len(s2) < minlength):
+            if used[skey]:
                 continue
+            # For the partial match, only the shorter word can be a prefix of the other, so a single startswith() is needed
             if s1 == s2 or \
-            (partial and (s1.startswith(s2) or s2.startswith(s1))) or \
-            (dist and distance.nlevenshtein(s1, s2, method=1) <= dist):
+            (partial and (s1_startswith(s2) if len(s2) <= len1 else s2.startswith(s1))) or \
+            (dist and leq(s1, s2, dist)):
                 count_eq += 1
-                del seq2_c[skey]
+                count_free -= 1
+                used[skey] = 1
                 break
-    # Prepare the result to return
+    return count_eq
+
+def _distance_jaccard_words_result(count_eq, count_total, norm):
+    """Convert the count of equal words to the distance returned by distance_jaccard_words()"""
     if norm is None:
         # Just return the count of equal words
         return count_eq
@@ -127,15 +308,73 @@ def distance_jaccard_words(seq1, seq2, partial=True, norm=False, dist=0, minleng
             # Return number of different words
             return count_total - count_eq
 
+def distance_jaccard_words(seq1, seq2, partial=True, norm=False, dist=0, minlength=0):
+    """Jaccard distance on two lists of words. Any permutation is tested, so the resulting distance is insensitive to words order."""
+    # The goal was to have a distance on words that 1- is insensible to permutation ; 2- returns 0.2 or less if only one or two words are different, except if one of the lists has only one entry! ; 3- insensible to shortened name ; 4- allow for similar but not totally exact words.
+    seq1_c = [w for w in seq1 if w]
+    seq2_c = [w for w in seq2 if w]
+    count_total = len(seq1_c) + len(seq2_c)
+    if minlength:
+        # Words shorter than minlength can never match, but they are still counted in count_total
+        seq1_c = [w for w in seq1_c if len(w) >= minlength]
+    count_eq = _distance_jaccard_words_count(seq1_c, seq2_c, partial, dist, minlength)
+    return _distance_jaccard_words_result(count_eq, count_total, norm)
+
+def distance_jaccard_words_many(seq1, seqs, partial=True, norm=False, dist=0, minlength=0):
+    """Bulk version of distance_jaccard_words(): compute the distance between the list of words seq1 and each list of words in seqs, and return the list of distances (in seqs order).
+    seq1 is prepared only once for all the comparisons, which is faster when matching one name against lots of names."""
+    seq1_c = [w for w in seq1 if w]
+    count1 = len(seq1_c)
+    if minlength:
+        seq1_c = [w for w in seq1_c if len(w) >= minlength]
+    res = []
+    for seq2 in seqs:
+        seq2_c = [w for w in seq2 if w]
+        count_eq = _distance_jaccard_words_count(seq1_c, seq2_c, partial, dist, minlength)
+        res.append(_distance_jaccard_words_result(count_eq, count1 + len(seq2_c), norm))
+    return res
+
+def distance_jaccard_words_bound(count1, count2):
+    """Lower bound of the normalized distance_jaccard_words() between two lists of count1 and count2 (non empty) words: at most min(count1, count2) words can be equal.
+    This allows to skip the comparison of names with very different numbers of words, without computing any words distance."""
+    count_total = count1 + count2
+    if not count_total:
+        return 0.0
+    return 1.0 - (2.0 * min(count1, count2) / count_total)
+
+def split_words(s, wordsplit_pattern=None):
+    """Split a sentence in words, the same way as distance_jaccard_words_split does. This allows to split each sentence only once and then call distance_jaccard_words directly when comparing lots of pairs."""
+    if not wordsplit_pattern:
+        return WORDSPLIT_REGEX.split(s)
+    return re.split(wordsplit_pattern, s)
+
 def distance_jaccard_words_split(s1, s2, *args, **kwargs):
     """Split sentences in words and call distance jaccard for words"""
-    wordsplit_pattern = kwargs.get('wordsplit_pattern', None)
-    if 'wordsplit_pattern' in kwargs:
-        del kwargs['wordsplit_pattern']
-    if not wordsplit_pattern:
-        wordsplit_pattern = r'-+|\s+|,+|\.+|/+';
+    wordsplit_pattern = kwargs.pop('wordsplit_pattern', None)
+    return distance_jaccard_words(split_words(s1, wordsplit_pattern), split_words(s2, wordsplit_pattern), *args, **kwargs)
 
-    return distance_jaccard_words(re.split(wordsplit_pattern, s1), re.split(wordsplit_pattern, s2), *args, **kwargs)
+def get_bigrams(s):
+    """Get the set of letters bigrams of a string. Words separators (same as distance_jaccard_words_split) are converted to spaces and a space is prepended, so that the first letter of each word is also a bigram. An empty string gets an empty bigram, so that it can still be matched with other empty strings."""
+    if not s:
+        return set([''])
+    s = ' ' + WORDSEP_REGEX.sub(' ', s)
+    return set(s[i:i+2] for i in range(len(s)-1))
+
+def build_bigrams_index(L):
+    """Build an inverted index from each bigram to the list of indices of the strings in L containing this bigram.
+    This is used for blocking: two names (or two words of these names) below a normalized levenshtein distance < 0.5 necessarily share at least one bigram, so only the strings sharing a bigram need to be compared."""
+    index = {}
+    for idx, s in enumerate(L):
+        for bigram in get_bigrams(s):
+            index.setdefault(bigram, []).append(idx)
+    return index
+
+def get_bigrams_candidates(s, index):
+    """Get the set of indices of the strings in the bigrams index that share at least one bigram with s"""
+    candidates = set()
+    for bigram in get_bigrams(s):
+        candidates.update(index.get(bigram, ()))
+    return candidates
 
 def fullpath(relpath):
     '''Relative path to absolute'''
@@ -143,64 +382,167 @@ def fullpath(relpath):
         relpath = relpath.name
     return os.path.abspath(os.path.expanduser(relpath))
 
-def recwalk(inputpath, sorting=True, folders=False, topdown=True, filetype=None):
-    '''Recursively walk through a folder. This provides a mean to flatten out the files restitution (necessary to show a progress bar). This is a generator.'''
+def recwalk(inputpath, sorting=False, folders=False, topdown=True, filetype=None):
+    '''Recursively walk through a folder. This provides a mean to flatten out the files restitution (necessary to show a progress bar). This is a generator. Files are returned in the filesystem order unless sorting=True, which costs a sort of each folder's listing.'''
     if filetype and isinstance(filetype, list):
         filetype = tuple(filetype)  # str.endswith() only accepts a tuple, not a list
     # If it's only a single file, return this single file
     if os.path.isfile(inputpath):
-        abs_path = fullpath(inputpath)
-        yield os.path.dirname(abs_path), os.path.basename(abs_path)
+        yield os.path.split(fullpath(inputpath))
     # Else if it's a folder, walk recursively and return every files
     else:
-        for dirpath, dirs, files in walk(inputpath, topdown=topdown):	
+        sort_dirs = sorting and (topdown or folders)  # in bottom-up mode, the recursion is already done when we get dirs, so only sort them if we return them
+        for dirpath, dirs, files in walk(inputpath, topdown=topdown):  # scandir based walk, the files and dirs types come from the directory entries without a stat() per entry
             if sorting:
                 files.sort()
-                dirs.sort()  # sort directories in-place for ordered recursive walking
+                if sort_dirs:
+                    dirs.sort()  # sort directories in-place for ordered recursive walking
             # return each file
-            for filename in files:
-                if not filetype or filename.endswith(filetype):
-                    yield (dirpath, filename)  # return directory (full path) and filename
+            if filetype:
+                for filename in files:
+                    if filename.endswith(filetype):
+                        yield (dirpath, filename)  # return directory (full path) and filename
+            else:
+                for filename in files:
+                    yield (dirpath, filename)
             # return each directory
             if folders:
                 for folder in dirs:
                     yield (dirpath, folder)
 
+def walk_files(inputpath, sorting=True, filetype=None):
+    '''Recursively walk through the files of a folder, in the same order as recwalk(), but using scandir() entries types to avoid a stat() call per entry. This is a generator, so that it is cheap to stop at the first file of interest.'''
+    if scandir is None or os.path.isfile(inputpath):
+        for x in recwalk(inputpath, sorting=sorting, filetype=filetype):
+            yield x
+        return
+    if filetype and isinstance(filetype, list):
+        filetype = tuple(filetype)  # str.endswith() only accepts a tuple, not a list
+    try:
+        entries = list(scandir(inputpath))
+    except OSError:
+        # unreadable folder, skip it like os.walk() does
+        return
+    files = []
+    dirs = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink():  # do not follow symlinks to folders, like os.walk()
+                    dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        except OSError:
+            files.append(entry.name)
+    if sorting:
+        files.sort()
+        dirs.sort()
+    # return each file, then walk each subfolder
+    for filename in files:
+        if not filetype or filename.endswith(filetype):
+            yield (inputpath, filename)
+    for folder in dirs:
+        for x in walk_files(os.path.join(inputpath, folder), sorting=sorting, filetype=filetype):
+            yield x
+
 def sort_list_a_given_list_b(list_a, list_b):
-    return sorted(list_a, key=lambda x: list_b.index(x))
+    '''Sort list_a given the order of the items in list_b. list_b can also be a precomputed dict of item -> rank, to avoid rebuilding it at each call when sorting lots of lists in the same order.'''
+    if not isinstance(list_b, dict):
+        ranks = {}
+        for rank, item in enumerate(list_b):
+            ranks.setdefault(item, rank)  # keep the first position, like list.index()
+        list_b = ranks
+    return sorted(list_a, key=list_b.__getitem__)
+
+def memoize(maxsize=131072):
+    '''Decorator to cache the results of a pure function with hashable arguments, like functools.lru_cache() (which is unavailable in Python 2). When maxsize results are cached, the cache is emptied instead of evicting the least recently used one, which is enough for our use (the same patient names are processed over and over). The cache can be reset with the decorated function's cache_clear().'''
+    def decorator(func):
+        cache = {}
+        def wrapper(*args, **kwargs):
+            # the types are part of the key, because in Python 2 'abc' == u'abc' but the result may not be of the same type
+            key = args + tuple(type(arg) for arg in args)
+            if kwargs:
+                key += tuple(sorted(kwargs.items()))
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            result = func(*args, **kwargs)
+            if len(cache) >= maxsize:
+                cache.clear()
+            cache[key] = result
+            return result
+        wrapper.cache_clear = cache.clear
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+# Weird encodings that even ftfy cannot fix, and their replacement
+BUGGY_ACCENTS = list({
+    '\xc4\x82\xc2\xa8': 'e',
+    'ĂŠ': 'e',
+    'Ăť': 'u',
+    'â': 'a',
+    'Ă´': 'o',
+    'Â°': '°',
+    'â': "'",
+    'ĂŞ': 'e',
+    'ÂŤ': '«',
+    'Âť': '»',
+    'Ă': 'a',
+    'AŠ': 'e',
+    'AŞ': 'e',
+    'A¨': 'e',
+    'A¨': 'e',
+    'Ă': 'E',
+    'â˘': '*',
+    'č': 'e',
+    '’': '\'',
+}.items())  # the replacements are applied sequentially in this order, since some patterns overlap
+_buggy_accents_decoded = {None: BUGGY_ACCENTS}  # BUGGY_ACCENTS decoded once for each encoding
+_buggy_accents_regex = {}  # for each encoding, a regex matching any of the patterns, to find in one pass if there is anything to replace
+NONASCII_REGEX = re.compile(u'[^\x00-\x7f]')
+NONASCII_BYTES_REGEX = re.compile(b'[^\x00-\x7f]')  # same for bytes strings (bytes.isascii() is only available since Python 3.7)
 
+@memoize()
 def replace_buggy_accents(s, encoding=None):
     """Fix weird encodings that even ftfy cannot fix"""
-    # todo enhance speed? or is it the new regex on name?
-    dic_replace = {
-        '\xc4\x82\xc2\xa8': 'e',
-        'ĂŠ': 'e',
-        'Ăť': 'u',
-        'â': 'a',
-        'Ă´': 'o',
-        'Â°': '°',
-        'â': "'",
-        'ĂŞ': 'e',
-        'ÂŤ': '«',
-        'Âť': '»',
-        'Ă': 'a',
-        'AŠ': 'e',
-        'AŞ': 'e',
-        'A¨': 'e',
-        'A¨': 'e',
-        'Ă': 'E',
-        'â˘': '*',
-        'č': 'e',
-        '’': '\'',
-    }
-    for pat, rep in dic_replace.items():
-        if encoding:
-            pat = pat.decode(encoding)
-            rep = rep.decode(encoding)
+    if not NONASCII_REGEX.search(s):
+        # all the patterns contain non ascii characters, so there is nothing to replace in an ascii string
+        if encoding and isinstance(s, bytes):
+            s = s.decode('ascii')  # same as replacing with decoded patterns (which converts s to unicode)
+        return s
+    if encoding not in _buggy_accents_regex:
+        if encoding not in _buggy_accents_decoded:
+            _buggy_accents_decoded[encoding] = [(pat.decode(encoding), rep.decode(encoding)) for pat, rep in BUGGY_ACCENTS]
+        _buggy_accents_regex[encoding] = re.compile('|'.join(re.escape(pat) for pat, _ in _buggy_accents_decoded[encoding]))
+    if isinstance(s, type(_buggy_accents_decoded[encoding][0][0])) and not _buggy_accents_regex[encoding].search(s):
+        # none of the patterns is in the string (eg, correctly encoded accents), and the replacements can only create new matches if a first one was found
+        return s
+    # Replace sequentially (not in a single pass), since some patterns overlap and a replacement can make a later pattern match
+    for pat, rep in _buggy_accents_decoded[encoding]:
         s = s.replace(pat, rep)
     return s
 
+_decoders = {}  # codecs decoders, looked up only once per encoding
+
+@memoize()
 def cleanup_name(s, encoding='latin1'):
-    s = _unidecode(s.decode(encoding).replace('^', ' ')).lower().strip()
-    s = re.sub('\-+', '-', re.sub('\s+', ' ', re.sub('[^a-zA-Z0-9\-]', ' ', s))).strip().replace('\r', '').replace('\n', '').replace('\t', '').replace(',', ' ').replace('  ', ' ').strip()  # clean up spaces, punctuation and double dashes in name
+    if isinstance(s, bytes) and not NONASCII_BYTES_REGEX.search(s):
+        # ascii name (the most common case): unidecode would return it unchanged, so skip the decoding and the unidecode lookups (assumes an ascii compatible encoding such as latin1 or utf8)
+        if bytes is not str:
+            s = s.decode('ascii')  # Python 3: unidecode returns a str, keep the same return type
+        s = s.lower()
+    else:
+        if isinstance(s, bytes):
+            # decode the bytes, names that are already unicode are used as-is
+            try:
+                decoder = _decoders[encoding]
+            except KeyError:
+                decoder = _decoders[encoding] = codecs.getdecoder(encoding)
+            s = decoder(s)[0]
+        s = _unidecode(s).lower()
+    # clean up spaces, punctuation and double dashes in name: each run of non alphanumerical characters (including whitespaces, ^ and commas) is replaced by a single space
+    s = DASHES_REGEX.sub('-', NONALNUM_REGEX.sub(' ', s)).strip()
     return s